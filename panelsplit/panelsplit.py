@@ -1,4 +1,3 @@
-from sklearn.model_selection import TimeSeriesSplit
 from tqdm import tqdm
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -7,13 +6,32 @@ import numpy as np
 from sklearn.base import clone
 import warnings
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the NumPy gathers are used instead
+    njit = None
+
+if njit is not None:
+    @njit(cache=True)
+    def _gather_fold_masks(codes, train_lut, test_lut):
+        n = codes.shape[0]
+        train_mask = np.empty(n, dtype=np.bool_)
+        test_mask = np.empty(n, dtype=np.bool_)
+        for i in range(n):
+            c = codes[i]
+            train_mask[i] = train_lut[c]
+            test_mask[i] = test_lut[c]
+        return train_mask, test_mask
+else:
+    _gather_fold_masks = None
+
 class PanelSplit:
-    def __init__(self, periods, unique_periods= None, snapshots = None, n_splits = 5, gap = 0, test_size = 1, max_train_size=None, plot=False, drop_splits=False, y=None, progress_bar=False):
+    def __init__(self, periods, unique_periods= None, snapshots = None, n_splits = 5, gap = 0, test_size = 1, max_train_size=None, plot=False, drop_splits=False, y=None, progress_bar=False, n_jobs=1):
         """
         A class for performing time series cross-validation with custom train/test splits based on unique periods.
 
         Parameters:
-        - periods: A pandas Series containing all available training periods.
+        - periods: A pandas Series containing all available training periods. Rows with missing periods (NaN/NaT) are left out of the derived unique set and never fall in any split's train or test set.
         - unique_periods: Optional. Pandas DataFrame or Series containing unique periods.
         - snapshots: Optional. A Pandas Series defining the snapshot for the observation (when it was updated)
         - n_splits: Number of splits for TimeSeriesSplit.
@@ -24,14 +42,21 @@ class PanelSplit:
         - drop_splits: Whether to drop splits with empty or single-value train or test sets.
         - y: Target variable to assess whether splits contain empty or single-value train or test sets. Required if drop_splits is True.
         - progress_bar: Bool. Whether or not to use the tqdm progress bar.
+        - n_jobs: Optional int (default=1). The default number of jobs for the cross_val methods to run in parallel.
         """
 
+        codes, uniques = pd.factorize(periods, sort=True)
+        self._codes = np.ascontiguousarray(codes, dtype=np.int32)
+        self._uniques = pd.Index(uniques)
         if unique_periods is None:
-            unique_periods = pd.Series(periods.unique()).sort_values()
-        self.tss = TimeSeriesSplit(n_splits=n_splits, gap=gap, test_size=test_size, max_train_size = max_train_size)
-        indices = self.tss.split(unique_periods.reset_index(drop=True))
+            unique_periods = pd.Series(uniques)
+        indices = self._time_series_indices(len(unique_periods), n_splits, gap, test_size, max_train_size)
         self.u_periods_cv = self._split_unique_periods(indices, unique_periods)
         self.all_periods = periods
+        self._fold_luts = [
+            (self._period_lut(train_periods), self._period_lut(test_periods))
+            for train_periods, test_periods in self.u_periods_cv
+        ]
         self.snapshots = snapshots
     
         if y is not None and drop_splits is False:
@@ -42,12 +67,42 @@ class PanelSplit:
         
         self.drop_splits = drop_splits
         self.progress_bar = progress_bar
+        self.n_jobs = n_jobs
         self.n_splits = n_splits
-        self.split(y=y, init=True)
+        self._cached_indices = None
+        if drop_splits:
+            # Dropping splits adjusts n_splits and validates y, so it has to
+            # run eagerly; otherwise fold construction waits for first use.
+            self.split(y=y, init=True)
 
         if plot:
             self._plot_time_series_splits(self.u_periods_cv)
         
+    @staticmethod
+    def _time_series_indices(n_samples, n_splits, gap, test_size, max_train_size):
+        """
+        Yield TimeSeriesSplit-style (train_index, test_index) arrays.
+
+        The fold boundaries follow from plain integer arithmetic over the
+        sorted unique periods, so the index arrays are generated directly
+        instead of going through sklearn's splitter. Matches TimeSeriesSplit
+        semantics for n_splits, gap, test_size and max_train_size, including
+        its validation errors.
+        """
+        if n_splits <= 1:
+            raise ValueError(f"k-fold cross-validation requires at least one train/test split by setting n_splits=2 or more, got n_splits={n_splits}.")
+        n_folds = n_splits + 1
+        if test_size is None:
+            test_size = n_samples // n_folds
+        if n_folds > n_samples:
+            raise ValueError(f"Cannot have number of folds={n_folds} greater than the number of samples={n_samples}.")
+        if n_samples - gap - test_size * n_splits <= 0:
+            raise ValueError(f"Too many splits={n_splits} for number of samples={n_samples} with test_size={test_size} and gap={gap}.")
+        for test_start in range(n_samples - n_splits * test_size, n_samples, test_size):
+            train_end = test_start - gap
+            train_start = max(train_end - max_train_size, 0) if max_train_size else 0
+            yield np.arange(train_start, train_end), np.arange(test_start, test_start + test_size)
+
     def _split_wrapper(self, indices):
         if self.progress_bar:
             return tqdm(indices)
@@ -72,27 +127,85 @@ class PanelSplit:
             u_periods_cv.append((unique_train_periods, unique_test_periods))
         return u_periods_cv
 
+    def _period_lut(self, fold_periods):
+        """
+        Build a boolean lookup table over period codes for fold_periods.
+
+        The codes of the fold periods key into a small boolean lookup table
+        which is then gathered with the precomputed int32 period codes, so
+        membership is a single vectorized gather rather than a hash-based isin
+        pass over the full panel. The final slot stays False so codes of -1
+        (periods missing from the unique set) never match.
+        """
+        fold_codes = self._uniques.get_indexer(fold_periods)
+        lut = np.zeros(len(self._uniques) + 1, dtype=bool)
+        lut[fold_codes[fold_codes >= 0]] = True
+        return lut
+
+    @staticmethod
+    def _is_constant(values):
+        """
+        Check whether values holds exactly one distinct non-NA value.
+
+        For numeric dtypes a min/max comparison replaces the hash pass that
+        nunique performs; object dtypes fall back to pd.unique.
+        """
+        values = values[pd.notna(values)]
+        if values.size == 0:
+            return False
+        if values.dtype.kind in 'biufmM':
+            return values.min() == values.max()
+        return pd.unique(values).size == 1
+
+    def _fold_masks(self, train_lut, test_lut):
+        """
+        Build the train and test membership masks for one fold's lookup tables.
+
+        When numba is installed, a fused JIT kernel fills both masks in a
+        single pass over the code array; otherwise two NumPy gathers are used.
+        """
+        if _gather_fold_masks is not None:
+            return _gather_fold_masks(self._codes, train_lut, test_lut)
+        return train_lut[self._codes], test_lut[self._codes]
+
     def split(self, X = None, y = None, groups=None, init=False):
         """
         Generate train/test indices based on unique periods.
+
+        Each split is a tuple of positional int64 index arrays suitable for
+        iloc, which keeps per-fold memory proportional to the fold size rather
+        than the full panel length. The indices are computed once and cached;
+        subsequent calls return the cached list so the downstream cross_val
+        methods don't rebuild the fold masks on every call. Construction is
+        lazy: unless drop_splits forced an eager build in __init__, the first
+        call does the work and later calls hit the cache.
         """
+        if not init:
+            if self._cached_indices is not None:
+                return self._cached_indices
+            init = True
+
         self.all_indices = []
-       
+        y_arr = np.asarray(y) if self.drop_splits else None
+
         for i, (train_periods, test_periods) in enumerate(self.u_periods_cv):
             if self.snapshots is not None:
                 if test_periods.max() >= self.snapshots.min():
-                    snapshot_val = test_periods.max()  
+                    snapshot_val = test_periods.max()
                 else:
                     snapshot_val = self.snapshots.min()
                     if init:
                         warnings.warn(f'The maximum period value {test_periods.max()} for split {i} is less than the minimum snapshot value {self.snapshots.min()}. Defaulting to minimum snapshot value for split {i}.', stacklevel=2)
-                train_indices = self.all_periods.isin(train_periods).values & (self.snapshots == snapshot_val)
-                test_indices = self.all_periods.isin(test_periods).values & (self.snapshots == snapshot_val)
+                train_mask, test_mask = self._fold_masks(*self._fold_luts[i])
+                snapshot_mask = (self.snapshots == snapshot_val).values
+                train_indices = np.flatnonzero(train_mask & snapshot_mask)
+                test_indices = np.flatnonzero(test_mask & snapshot_mask)
             else:
-                train_indices = self.all_periods.isin(train_periods).values
-                test_indices = self.all_periods.isin(test_periods).values 
+                train_mask, test_mask = self._fold_masks(*self._fold_luts[i])
+                train_indices = np.flatnonzero(train_mask)
+                test_indices = np.flatnonzero(test_mask)
 
-            if self.drop_splits and ((len(train_indices) == 0 or len(test_indices) == 0) or (y.loc[train_indices].nunique() == 1 or y.loc[test_indices].nunique() == 1)):
+            if self.drop_splits and ((len(train_indices) == 0 or len(test_indices) == 0) or (self._is_constant(y_arr[train_indices]) or self._is_constant(y_arr[test_indices]))):
                 if init:
                     self.n_splits -= 1
                     print(f'Dropping split {i} as either the test or train set is either empty or contains only one unique value.')
@@ -100,6 +213,7 @@ class PanelSplit:
                     continue
             else:
                 self.all_indices.append((train_indices, test_indices))
+        self._cached_indices = self.all_indices
         return self.all_indices
    
     def get_n_splits(self, X=None, y =None, groups=None):
@@ -120,17 +234,16 @@ class PanelSplit:
         A pandas DataFrame where each split has its own set of observations.
         """
 
-        _data = data.copy()
         splits = self.split()
-        snapshots = []
-        for i, split in enumerate(splits):
-            split_indices = np.array([split[0], split[1]]).any(axis = 0)
-            if period_col is not None:
-                last_period = _data.loc[split_indices, period_col].unique().max()
-                snapshots.append(_data.loc[split_indices].assign(split = i, snapshot_period = last_period))
-            else:
-                snapshots.append(_data.loc[split_indices].assign(split = i))
-        return pd.concat(snapshots)
+        positions = [np.union1d(split[0], split[1]) for split in splits]
+        lengths = [len(pos) for pos in positions]
+        snapshots = data.iloc[np.concatenate(positions)]
+        snapshots['split'] = np.repeat(np.arange(len(splits)), lengths)
+        if period_col is not None:
+            last_periods = pd.Series([data[period_col].iloc[pos].unique().max() for pos in positions],
+                                     dtype=data[period_col].dtype)
+            snapshots['snapshot_period'] = last_periods.repeat(lengths).values
+        return snapshots
     
     def gen_test_labels(self, labels):
         """
@@ -142,34 +255,47 @@ class PanelSplit:
         Returns:
         The labels of each fold's test set as a single DataFrame.
         """
-        test_indices = np.stack([split[1] for split in self.split()], axis=1).any(axis=1)
-        return labels.loc[test_indices].copy()
+        test_indices = np.unique(np.concatenate([split[1] for split in self.split()]))
+        return labels.iloc[test_indices]
+
+    @staticmethod
+    def _stack_predictions(predictions):
+        """
+        Stack per-fold prediction arrays into a single preallocated array.
+
+        Equivalent to np.concatenate along axis 0, but writes each fold into
+        the output buffer and releases it immediately, so peak memory is the
+        output plus one fold rather than the output plus all folds.
+        """
+        total = sum(len(pred) for pred in predictions)
+        out = np.empty((total,) + predictions[0].shape[1:], dtype=predictions[0].dtype)
+        start = 0
+        for i, pred in enumerate(predictions):
+            out[start:start + len(pred)] = pred
+            start += len(pred)
+            predictions[i] = None
+        return out
+
+    _prediction_methods = ('predict', 'predict_proba', 'predict_log_proba')
 
     def _predict_split(self, model, X_test, prediction_method='predict'):
         """
         Perform predictions for a single split.
 
         Parameters:
-        - estimator: The machine learning model used for prediction.
-        - X_train: pandas DataFrame. The input features for training.
-        - y_train: pandas Series. The target variable for training.
+        - model: The fitted machine learning model used for prediction.
         - X_test: pandas DataFrame. The input features for testing.
         - prediction_method: Optional str (default='predict'). The prediction method to use. It can be 'predict', 'predict_proba', or 'predict_log_proba'.
 
         Returns:
-        pd.Series: Series containing predicted values.
+        np.ndarray: Array containing predicted values.
         """
 
-        if prediction_method == 'predict':
-            return model.predict(X_test)
-        elif prediction_method == 'predict_proba':
-            return model.predict_proba(X_test)
-        elif prediction_method == 'predict_log_proba':
-            return model.predict_log_proba(X_test)
-        else:
+        if prediction_method not in self._prediction_methods:
             raise ValueError("Invalid prediction_method. Supported values are 'predict', 'predict_proba', or 'predict_log_proba'.")
+        return getattr(model, prediction_method)(X_test)
 
-    def cross_val_fit(self, estimator, X, y, sample_weight=None, n_jobs=1):
+    def cross_val_fit(self, estimator, X, y, sample_weight=None, n_jobs=None):
         """
         Fit the estimator using cross-validation.
 
@@ -178,18 +304,21 @@ class PanelSplit:
         - X: pandas DataFrame. The input features for the estimator.
         - y: pandas Series. The target variable for the estimator.
         - sample_weight: Optional pandas Series or numpy array (default=None). Sample weights for the training data.
-        - n_jobs: Optional int (default=1). The number of jobs to run in parallel.
+        - n_jobs: Optional int (default=None). The number of jobs to run in parallel. Defaults to the n_jobs passed to the constructor.
 
         Returns:
         list of fitted models: List containing fitted models for each split.
         """
+        if n_jobs is None:
+            n_jobs = self.n_jobs
+        notna_mask = y.notna().to_numpy()
+        sw_arr = np.asarray(sample_weight) if sample_weight is not None else None
+
         def fit_split(train_indices):
-            y_train = y.loc[train_indices].dropna()
-            X_train = X.loc[y_train.index]
-            if sample_weight is not None:
-                sw = sample_weight.loc[y_train.index]
-            else:
-                sw = None
+            train_positions = train_indices[notna_mask[train_indices]]
+            y_train = y.iloc[train_positions]
+            X_train = X.iloc[train_positions]
+            sw = sw_arr[train_positions] if sw_arr is not None else None
             return estimator.fit(X_train, y_train, sample_weight=sw)
 
         fitted_estimators = Parallel(n_jobs=n_jobs)(
@@ -198,7 +327,7 @@ class PanelSplit:
         )
         return fitted_estimators
 
-    def cross_val_predict(self, fitted_estimators, X, prediction_method='predict', n_jobs=1, return_train_preds=False):
+    def cross_val_predict(self, fitted_estimators, X, prediction_method='predict', n_jobs=None, return_train_preds=False):
         """
         Perform cross-validated predictions using a given predictor model.
 
@@ -207,15 +336,19 @@ class PanelSplit:
         - X: pandas DataFrame. The input features for the predictor.
         - labels: Optional pandas DataFrame. Labels to identify the predictions, if provided will be returned along with predictions.
         - prediction_method: Optional str (default='predict'). The prediction method to use. It can be 'predict', 'predict_proba', or 'predict_log_proba'.
-        - n_jobs: Optional int (default=1). The number of jobs to run in parallel.
+        - n_jobs: Optional int (default=None). The number of jobs to run in parallel. Defaults to the n_jobs passed to the constructor.
         - return_train_preds: Optional bool (default=False). If True, return predictions for the training set as well.
 
         Returns:
         pd.DataFrame: Concatenated DataFrame containing predictions made by the model during cross-validation. It includes the original labels joined with the predicted values.
         """
+        if n_jobs is None:
+            n_jobs = self.n_jobs
+        if prediction_method not in self._prediction_methods:
+            raise ValueError("Invalid prediction_method. Supported values are 'predict', 'predict_proba', or 'predict_log_proba'.")
+
         def predict_split(model, test_indices):
-            X_test = X.loc[test_indices]
-            return self._predict_split(model, X_test, prediction_method)
+            return getattr(model, prediction_method)(X.iloc[test_indices])
 
         predictions = Parallel(n_jobs=n_jobs)(
             delayed(predict_split)(fitted_estimators[i], test_indices)
@@ -227,14 +360,14 @@ class PanelSplit:
                 delayed(predict_split)(fitted_estimators[i], train_indices)
                 for i, (train_indices, _) in enumerate(self.split())
             )
-            return np.concatenate(predictions, axis = 0), np.concatenate(train_preds, axis = 0)
-        
+            return self._stack_predictions(predictions), self._stack_predictions(train_preds)
+
         else:
-            return np.concatenate(predictions, axis = 0)
+            return self._stack_predictions(predictions)
 
         
 
-    def cross_val_fit_predict(self, estimator, X, y, prediction_method='predict', sample_weight=None, n_jobs=1, return_train_preds=False):
+    def cross_val_fit_predict(self, estimator, X, y, prediction_method='predict', sample_weight=None, n_jobs=None, return_train_preds=False, return_fitted_models=True):
         """
         Fit the estimator using cross-validation and then make predictions.
 
@@ -244,8 +377,9 @@ class PanelSplit:
         - y: pandas Series. The target variable for the estimator.
         - prediction_method: Optional str (default='predict'). The prediction method to use. It can be 'predict', 'predict_proba', or 'predict_log_proba'.
         - sample_weight: Optional pandas Series or numpy array (default=None). Sample weights for the training data.
-        - n_jobs: Optional int (default=1). The number of jobs to run in parallel.
+        - n_jobs: Optional int (default=None). The number of jobs to run in parallel. Defaults to the n_jobs passed to the constructor.
         - return_train_preds: Optional bool (default=False). If True, return predictions for the training set as well.
+        - return_fitted_models: Optional bool (default=True). If False, the fitted models are not returned, so they can be freed instead of staying pinned in memory.
 
         Returns:
         pd.DataFrame: Concatenated DataFrame containing predictions made by the model during cross-validation. It includes the original indices joined with the predicted values.
@@ -256,10 +390,14 @@ class PanelSplit:
 
         if return_train_preds:
             preds, train_preds = self.cross_val_predict(fitted_estimators, X, prediction_method, n_jobs, return_train_preds)
-            return preds, train_preds, fitted_estimators
+            if return_fitted_models:
+                return preds, train_preds, fitted_estimators
+            return preds, train_preds
         else:
             preds = self.cross_val_predict(fitted_estimators, X, prediction_method, n_jobs)
-            return preds, fitted_estimators
+            if return_fitted_models:
+                return preds, fitted_estimators
+            return preds
             
     def _plot_time_series_splits(self, split_output):
         """
@@ -270,10 +408,11 @@ class PanelSplit:
         """
         splits = len(split_output)
         fig, ax = plt.subplots()
-        
-        for i, (train_index, test_index) in enumerate(split_output):
-            ax.scatter(train_index, [i] * len(train_index), color='blue', marker='.', s=50)
-            ax.scatter(test_index, [i] * len(test_index), color='red', marker='.', s=50)
+
+        xs = np.concatenate([np.concatenate([train_index, test_index]) for train_index, test_index in split_output])
+        ys = np.repeat(np.arange(splits), [len(train_index) + len(test_index) for train_index, test_index in split_output])
+        colors = np.concatenate([np.repeat(['blue', 'red'], [len(train_index), len(test_index)]) for train_index, test_index in split_output])
+        ax.scatter(xs, ys, c=colors, marker='.', s=50)
 
         ax.set_xlabel('Periods')
         ax.set_ylabel('Split')
@@ -282,7 +421,7 @@ class PanelSplit:
         ax.set_yticklabels([f'{i}' for i in range(splits)])  # Set custom labels for y-axi
         plt.show()
 
-    def _cross_val_fit(self, transformer, X, include_test_in_fit=False, n_jobs=1):
+    def _cross_val_fit(self, transformer, X, include_test_in_fit=False, n_jobs=None):
         """
         Perform cross-validated fitting using a given transformer.
 
@@ -294,23 +433,24 @@ class PanelSplit:
         Returns:
         list of fitted transformers: List containing fitted transformers for each split.
         """
-        transformers = []
+        if n_jobs is None:
+            n_jobs = self.n_jobs
 
         def fit_split(train_indices, test_indices):
-            X_train = X.loc[train_indices]
+            X_train = X.iloc[train_indices]
             if include_test_in_fit:
-                return transformer.fit(X_train, X.loc[test_indices])
+                return clone(transformer).fit(X_train, X.iloc[test_indices])
             else:
-                return transformer.fit(X_train)
+                return clone(transformer).fit(X_train)
 
-        fitted_transformers = Parallel(n_jobs=n_jobs)(
+        fitted_transformers = Parallel(n_jobs=n_jobs, backend='threading')(
             delayed(fit_split)(train_indices, test_indices)
             for train_indices, test_indices in self._split_wrapper(self.split())
         )
 
         return fitted_transformers
 
-    def cross_val_transform(self, transformers, X, transform_train = False, n_jobs=1):
+    def cross_val_transform(self, transformers, X, transform_train = False, n_jobs=None, out_path=None):
         """
         Perform cross-validated transformation using fitted transformers.
 
@@ -318,11 +458,13 @@ class PanelSplit:
         - transformers: List of fitted transformers.
         - X: pandas DataFrame. The input features for the transformation.
         - transform_train: Optional bool (default=False). If True, transform train set as well as the test set.
+        - out_path: Optional str (default=None). If provided, the transformed values are written to a memory-mapped file at this path instead of an in-memory array, bounding peak memory for panels that don't fit in RAM.
 
         Returns:
         pd.DataFrame: DataFrame containing transformed values during cross-validation.
         """
-        _X = X.copy()
+        if n_jobs is None:
+            n_jobs = self.n_jobs
 
         if transform_train:
             if self.snapshots is None:
@@ -330,19 +472,35 @@ class PanelSplit:
 
         def transform_split(transformer, train_indices, test_indices):
             if transform_train:
-                train_or_test = pd.concat([train_indices, test_indices], axis = 1).any(axis = 1)
-                _X.loc[train_or_test] = transformer.transform(X.loc[train_or_test])
+                positions = np.union1d(train_indices, test_indices)
             else:
-                _X.loc[test_indices] = transformer.transform(X.loc[test_indices])
-            
-        Parallel(n_jobs=n_jobs)(
+                positions = test_indices
+            return positions, transformer.transform(X.iloc[positions])
+
+        results = Parallel(n_jobs=n_jobs, backend='threading')(
             delayed(transform_split)(transformers[i], train_indices, test_indices)
             for i, (train_indices, test_indices) in enumerate(self.split())
         )
 
-        return _X
+        # Promote with the fold results so e.g. float transforms of an
+        # integer frame are not silently truncated on scatter.
+        out_dtype = np.result_type(X.iloc[:0].to_numpy().dtype,
+                                   *(transformed.dtype for _, transformed in results))
+
+        if out_path is not None:
+            out = np.memmap(out_path, dtype=out_dtype, mode='w+', shape=X.shape)
+            for j in range(X.shape[1]):
+                out[:, j] = X.iloc[:, j].to_numpy()
+        else:
+            out = X.to_numpy(dtype=out_dtype, copy=True)
+        for positions, transformed in results:
+            out[positions] = transformed
+        if out_path is not None:
+            out.flush()
+
+        return pd.DataFrame(out, index=X.index, columns=X.columns)
 
-    def cross_val_fit_transform(self, transformer, X, include_test_in_fit=False, transform_train=False, n_jobs = 1):
+    def cross_val_fit_transform(self, transformer, X, include_test_in_fit=False, transform_train=False, n_jobs=None, out_path=None):
         """
         Perform cross-validated fitting and transformation using a given transformer.
 
@@ -351,12 +509,13 @@ class PanelSplit:
         - X: pandas DataFrame. The input features for the transformer.
         - include_test_in_fit: Optional bool (default=False). If True, include test data in fitting the transformer.
         - transform_train: Optional bool (default=False). If True, transform train set as well as the test set.
+        - out_path: Optional str (default=None). If provided, the transformed values are written to a memory-mapped file at this path instead of an in-memory array.
 
         Returns:
         pd.DataFrame: DataFrame containing transformed values during cross-validation.
         list of fitted transformers: List containing fitted transformers for each split.
         """
         transformers = self._cross_val_fit(transformer, X, include_test_in_fit, n_jobs)
-        _X = self.cross_val_transform(transformers, X, transform_train, n_jobs)
+        _X = self.cross_val_transform(transformers, X, transform_train, n_jobs, out_path)
 
         return _X, transformers
\ No newline at end of file